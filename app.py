@@ -1,210 +1,733 @@
-from flask import Flask, request, jsonify
-from urllib.parse import urlparse, parse_qs
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 from dotenv import load_dotenv
-import whisper
+from faster_whisper import WhisperModel, BatchedInferencePipeline
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import redis.asyncio as redis
+import ctranslate2
+import numpy as np
 import os
-import uuid
+import re
+import functools
+import tempfile
+import threading
 import time
-import subprocess
+import hashlib
+import json
+import asyncio
+import atexit
+import queue
 import logging
+import logging.handlers
 import openai
+import httpx
+import yt_dlp
+import uvicorn
 
 load_dotenv()
 
-app = Flask(__name__)
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    if openai_client is not None:
+        await openai_client.close()
+    for executor in (whisper_executor, ytdl_executor):
+        executor.shutdown(wait=False, cancel_futures=True)
+
+app = FastAPI(lifespan=lifespan)
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        return json.dumps({
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        })
+
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
 
 logger = logging.getLogger("yt-transcriber")
 logger.setLevel(logging.INFO)
 handler = logging.StreamHandler()
-formatter = logging.Formatter('[%(asctime)s] %(levelname)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+if LOG_FORMAT == "json":
+    formatter = JsonFormatter(datefmt='%Y-%m-%dT%H:%M:%S%z')
+else:
+    formatter = logging.Formatter('[%(asctime)s] %(levelname)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 handler.setFormatter(formatter)
+# Request paths only enqueue records; a background listener thread does the stderr writes
+log_queue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(log_queue, handler)
 if not logger.hasHandlers():
-    logger.addHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+def available_cpu_count():
+    # os.cpu_count() reports every core of the host; a container only gets its CPU affinity and cgroup quota
+    count = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+    except (OSError, ValueError):
+        try:
+            # cgroup v1
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                quota = f.read().strip()
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = f.read().strip()
+        except OSError:
+            quota, period = "max", None
+    if quota not in ("max", "-1"):
+        count = min(count, int(quota) // int(period))
+    return max(count, 1)
 
+SAMPLE_RATE = 16000
 WHISPER_MODEL_SIZE = os.getenv("WHISPER_MODEL_SIZE", "base")
+WHISPER_BATCH_SIZE = int(os.getenv("WHISPER_BATCH_SIZE", "8"))
+WHISPER_NUM_WORKERS = max(int(os.getenv("WHISPER_NUM_WORKERS", "1")), 1)
+# Every gunicorn worker (WEB_CONCURRENCY) loads its own model, so the cores are shared between all of them
+WEB_CONCURRENCY = max(int(os.getenv("WEB_CONCURRENCY", "1")), 1)
+WHISPER_CPU_THREADS = int(os.getenv("WHISPER_CPU_THREADS", str(max(available_cpu_count() // (WHISPER_NUM_WORKERS * WEB_CONCURRENCY), 1))))
+# Only split speech on pauses of at least 500 ms so chunk boundaries don't cut words
+WHISPER_VAD_PARAMETERS = {"min_silence_duration_ms": 500}
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_WHISPER_MODEL = os.getenv("OPENAI_WHISPER_MODEL", "whisper-1")
-VALID_MODELS = ['tiny.en', 'tiny', 'base.en', 'base', 'small.en', 'small', 'medium.en', 'medium', 'large-v1', 'large-v2', 'large-v3', 'large', 'large-v3-turbo', 'turbo']
+VALID_MODELS = ['tiny.en', 'tiny', 'base.en', 'base', 'small.en', 'small', 'medium.en', 'medium', 'large-v1', 'large-v2', 'large-v3', 'large', 'large-v3-turbo', 'turbo', 'distil-small.en', 'distil-medium.en', 'distil-large-v2', 'distil-large-v3']
 if WHISPER_MODEL_SIZE not in VALID_MODELS:
-    logger.error(f"Invalid model size: {WHISPER_MODEL_SIZE}. Valid models: {VALID_MODELS}")
+    logger.error("Invalid model size: %s. Valid models: %s", WHISPER_MODEL_SIZE, VALID_MODELS)
     WHISPER_MODEL_SIZE = "base"
-logger.info(f"Loading Whisper model: {WHISPER_MODEL_SIZE}...")
+# Every Distil-Whisper checkpoint was distilled on English only, even distil-large-v2/v3 whose vocabulary is multilingual
+WHISPER_ENGLISH_ONLY = WHISPER_MODEL_SIZE.endswith(".en") or WHISPER_MODEL_SIZE.startswith("distil-")
+WHISPER_DEVICE = "cuda" if ctranslate2.get_cuda_device_count() > 0 else "cpu"
+DEFAULT_COMPUTE_TYPE = "int8_float16" if WHISPER_DEVICE == "cuda" else "int8"
+WHISPER_COMPUTE_TYPE = os.getenv("WHISPER_COMPUTE_TYPE", DEFAULT_COMPUTE_TYPE)
+SUPPORTED_COMPUTE_TYPES = ctranslate2.get_supported_compute_types(WHISPER_DEVICE)
+# "auto" and "default" are resolved by CTranslate2 itself and never appear in the supported list
+if WHISPER_COMPUTE_TYPE not in ("auto", "default") and WHISPER_COMPUTE_TYPE not in SUPPORTED_COMPUTE_TYPES:
+    logger.error("Unsupported compute type on %s: %s. Supported compute types: %s", WHISPER_DEVICE, WHISPER_COMPUTE_TYPE, sorted(SUPPORTED_COMPUTE_TYPES))
+    WHISPER_COMPUTE_TYPE = DEFAULT_COMPUTE_TYPE
+logger.info("Loading Whisper model: %s on %s (%s)...", WHISPER_MODEL_SIZE, WHISPER_DEVICE, WHISPER_COMPUTE_TYPE)
 start_load_time = time.time()
-whisper_model = whisper.load_model(WHISPER_MODEL_SIZE)
+whisper_model = WhisperModel(
+    WHISPER_MODEL_SIZE,
+    device=WHISPER_DEVICE,
+    compute_type=WHISPER_COMPUTE_TYPE,
+    cpu_threads=WHISPER_CPU_THREADS,
+    num_workers=WHISPER_NUM_WORKERS
+)
+batched_model = BatchedInferencePipeline(model=whisper_model)
+# The model only runs WHISPER_NUM_WORKERS transcriptions at once, so queued requests wait here instead of holding
+# threads of asyncio's default pool that extraction, downloads and hashing also need
+whisper_executor = ThreadPoolExecutor(max_workers=WHISPER_NUM_WORKERS, thread_name_prefix="whisper")
 load_time = time.time() - start_load_time
-logger.info(f"Whisper model '{WHISPER_MODEL_SIZE}' loaded in {load_time:.2f} seconds.")
+logger.info("Whisper model '%s' loaded in %.2f seconds.", WHISPER_MODEL_SIZE, load_time)
 
-TEMP_AUDIO_DIR = "temp_audio_files"
+# One client per process so the httpx connection pool and TLS sessions are reused across requests
+if OPENAI_API_KEY:
+    openai_client = openai.AsyncOpenAI(
+        api_key=OPENAI_API_KEY,
+        max_retries=3,
+        timeout=600,
+        # Keeps the SDK's own httpx defaults (timeouts, redirects) and only widens the pool
+        http_client=openai.DefaultAsyncHttpxClient(limits=httpx.Limits(max_connections=100, max_keepalive_connections=20))
+    )
+else:
+    openai_client = None
+
+DOWNLOAD_PROCESS_TIMEOUT_SECONDS = 1200
+DOWNLOAD_PROGRESS_LOG_INTERVAL_SECONDS = 10
+PROCESS_ERROR_TAIL_LINES = 50
+# yt-dlp extraction and downloads block a thread for up to DOWNLOAD_PROCESS_TIMEOUT_SECONDS, so they get their own pool too
+YT_DLP_MAX_WORKERS = max(int(os.getenv("YT_DLP_MAX_WORKERS", "16")), 1)
+ytdl_executor = ThreadPoolExecutor(max_workers=YT_DLP_MAX_WORKERS, thread_name_prefix="yt-dlp")
+YT_DLP_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+
+# tmpfs keeps the write-once/read-once audio files in RAM instead of on disk
+DEFAULT_TEMP_AUDIO_DIR = "/dev/shm/yt-transcriber" if os.path.isdir("/dev/shm") else "temp_audio_files"
+TEMP_AUDIO_DIR = os.getenv("TEMP_AUDIO_DIR", DEFAULT_TEMP_AUDIO_DIR)
 os.makedirs(TEMP_AUDIO_DIR, exist_ok=True)
-logger.info(f"Temporary audio directory ready: {TEMP_AUDIO_DIR}")
+logger.info("Temporary audio directory ready: %s", TEMP_AUDIO_DIR)
+
+REDIS_URL = os.getenv("REDIS_URL")
+CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_SECONDS", "604800"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1000"))
+# Resolved media URLs expire after a few hours, so extracted video info is only kept briefly
+VIDEO_INFO_CACHE_TTL_SECONDS = int(os.getenv("VIDEO_INFO_CACHE_TTL_SECONDS", "3600"))
+VIDEO_INFO_CACHE_MAX_ENTRIES = int(os.getenv("VIDEO_INFO_CACHE_MAX_ENTRIES", "100"))
+if REDIS_URL:
+    redis_client = redis.from_url(REDIS_URL, decode_responses=True)
+    logger.info("Transcription cache backend: Redis")
+else:
+    redis_client = None
+    logger.info("Transcription cache backend: in-memory LRU (max %s entries)", CACHE_MAX_ENTRIES)
+local_cache = OrderedDict()
+# Video info is much larger than a transcript, so it gets its own smaller LRU instead of evicting transcripts
+local_video_info_cache = OrderedDict()
+
+def transcription_cache_key(model, language, kind, value):
+    return f"trans:{model}:{language or 'auto'}:{kind}:{value}"
+
+async def cache_get(key, store=local_cache):
+    if redis_client is not None:
+        try:
+            return await redis_client.get(key)
+        except redis.RedisError as e:
+            logger.warning("Cache lookup failed for %s: %s", key, e)
+            return None
+
+    entry = store.get(key)
+    if entry is None:
+        return None
+    expires_at, value = entry
+    if expires_at < time.time():
+        del store[key]
+        return None
+    store.move_to_end(key)
+    return value
+
+async def cache_set(key, value, ttl=CACHE_TTL_SECONDS, store=local_cache, max_entries=CACHE_MAX_ENTRIES):
+    if redis_client is not None:
+        try:
+            await redis_client.set(key, value, ex=ttl)
+        except redis.RedisError as e:
+            logger.warning("Cache store failed for %s: %s", key, e)
+        return
+
+    store[key] = (time.time() + ttl, value)
+    store.move_to_end(key)
+    while len(store) > max_entries:
+        store.popitem(last=False)
+
+async def cache_delete(key, store=local_cache):
+    if redis_client is not None:
+        try:
+            await redis_client.delete(key)
+        except redis.RedisError as e:
+            logger.warning("Cache delete failed for %s: %s", key, e)
+        return
+
+    store.pop(key, None)
+
+def hash_audio_file(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as audio_file:
+        for chunk in iter(lambda: audio_file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# URLs are memoized below, so their length is bounded before they get there
+MAX_YOUTUBE_URL_LENGTH = 2048
+YOUTUBE_VIDEO_ID_RE = re.compile(r"[?&]v=([A-Za-z0-9_-]{11})(?![A-Za-z0-9_-])")
+
+@functools.lru_cache(maxsize=10000)
+def extract_video_id(youtube_url):
+    match = YOUTUBE_VIDEO_ID_RE.search(youtube_url)
+    return match.group(1) if match else None
 
+@functools.lru_cache(maxsize=10000)
 def clean_youtube_url(youtube_url):
-    parsed_url = urlparse(youtube_url)
-    query_params = parse_qs(parsed_url.query)
-    video_id = query_params.get('v', [None])[0]
+    video_id = extract_video_id(youtube_url)
     if video_id:
         return f"https://www.youtube.com/watch?v={video_id}"
     return youtube_url
 
-def download_audio(youtube_url, output_path_without_ext):
-    DOWNLOAD_PROCESS_TIMEOUT_SECONDS = 1200
+async def run_in_executor(executor, func, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+def ytdl_options(**overrides):
+    options = {
+        'quiet': True,
+        'no_warnings': True,
+        'socket_timeout': 60,
+        'retries': 10,
+        'http_headers': {'User-Agent': YT_DLP_USER_AGENT},
+        'cookiefile': 'cookies.txt',
+        # yt-dlp messages go straight to our logger instead of being buffered on stderr
+        'logger': logger,
+    }
+    options.update(overrides)
+    return options
+
+async def download_audio(youtube_url, output_path_without_ext):
     output_template = output_path_without_ext + ".%(ext)s"
-    cmd = [
-        'yt-dlp',
-        '--no-warnings',
-        '--format', 'bestaudio[ext=m4a]',
-        '--extract-audio',
-        '--audio-format', 'm4a',
-        '--output', output_template,
-        '--socket-timeout', '60',
-        '--retries', '10',
-        '--user-agent', 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-        '--cookies', 'cookies.txt',
-        youtube_url
-    ]
-    logger.info(f"Running yt-dlp command: {' '.join(cmd)}")
-    try:
-        result = subprocess.run(
-            cmd,
-            timeout=DOWNLOAD_PROCESS_TIMEOUT_SECONDS,
-            check=True,
-            capture_output=True,
-            text=True
+    deadline = time.monotonic() + DOWNLOAD_PROCESS_TIMEOUT_SECONDS
+    last_progress_log = [0.0]
+
+    def on_progress(progress):
+        # Only the built-in downloader reports 'downloading'; aria2c calls hooks once, with 'finished'
+        if progress.get('status') != 'downloading':
+            return
+        now = time.monotonic()
+        # Raising from a progress hook is the only way to stop the built-in downloader mid-transfer
+        if now > deadline:
+            raise yt_dlp.utils.DownloadCancelled("Download timed out")
+        if now - last_progress_log[0] >= DOWNLOAD_PROGRESS_LOG_INTERVAL_SECONDS:
+            last_progress_log[0] = now
+            downloaded_bytes = progress.get('downloaded_bytes') or 0
+            total_bytes = progress.get('total_bytes') or progress.get('total_bytes_estimate')
+            if total_bytes:
+                logger.info("yt-dlp download progress: %.1f%% of %.1f MB", 100 * downloaded_bytes / total_bytes, total_bytes / 1e6)
+            else:
+                logger.info("yt-dlp download progress: %.1f MB", downloaded_bytes / 1e6)
+
+    format_selector = 'bestaudio[ext=m4a]'
+
+    async def download_from_info(info):
+        remaining_seconds = int(deadline - time.monotonic())
+        if remaining_seconds <= 0:
+            logger.error("yt-dlp timed out after %s seconds.", DOWNLOAD_PROCESS_TIMEOUT_SECONDS)
+            raise RuntimeError("Download timed out")
+        options = ytdl_options(
+            format=format_selector,
+            outtmpl=output_template,
+            # The directory is per request, so a file already there is left over from a failed attempt
+            overwrites=True,
+            postprocessors=[{'key': 'FFmpegExtractAudio', 'preferredcodec': 'm4a'}],
+            progress_hooks=[on_progress],
+            # 16 parallel ranged connections get past per-connection CDN pacing; yt-dlp falls back to its own downloader without aria2c.
+            # aria2c runs as a blocking subprocess that progress hooks can't interrupt, so it is bounded by the remaining
+            # deadline (--stop) and drops stalled connections itself
+            external_downloader={'default': 'aria2c'},
+            external_downloader_args={'aria2c': [
+                '-x16', '-s16', '-k1M', '--file-allocation=none',
+                f'--stop={remaining_seconds}', '--timeout=60', '--lowest-speed-limit=10K'
+            ]},
+            concurrent_fragment_downloads=16
         )
-        logger.info(f"yt-dlp stdout: {result.stdout}")
-        logger.info(f"yt-dlp download completed successfully.")
-    except subprocess.TimeoutExpired:
-        logger.error(f"yt-dlp timed out after {DOWNLOAD_PROCESS_TIMEOUT_SECONDS} seconds.")
-        raise RuntimeError("Download timed out")
-    except subprocess.CalledProcessError as e:
-        logger.error(f"yt-dlp failed with error: {e.stderr.strip()}")
-        raise RuntimeError(f"yt-dlp error: {e.stderr.strip()}")
-
-    for ext in ['m4a', 'mp3', 'webm', 'opus']:
-        candidate = f"{output_path_without_ext}.{ext}"
-        if os.path.exists(candidate):
-            logger.info(f"Found downloaded audio file: {candidate}")
-            return candidate
+
+        def run_download():
+            # Downloads from the already extracted info, like yt-dlp --load-info-json
+            with yt_dlp.YoutubeDL(options) as ytdl:
+                return ytdl.process_ie_result(info, download=True)
+
+        logger.info("Running yt-dlp download for: %s", youtube_url)
+        try:
+            result = await run_in_executor(ytdl_executor, run_download)
+        except yt_dlp.utils.DownloadCancelled:
+            logger.error("yt-dlp timed out after %s seconds.", DOWNLOAD_PROCESS_TIMEOUT_SECONDS)
+            raise RuntimeError("Download timed out")
+        except yt_dlp.utils.DownloadError as e:
+            # aria2c stopped by --stop surfaces as a plain download error
+            if time.monotonic() >= deadline:
+                logger.error("yt-dlp timed out after %s seconds.", DOWNLOAD_PROCESS_TIMEOUT_SECONDS)
+                raise RuntimeError("Download timed out")
+            logger.error("yt-dlp failed with error: %s", e)
+            raise RuntimeError(f"yt-dlp error: {str(e)}")
+        logger.info("yt-dlp download completed successfully.")
+        return result
+
+    result = await download_with_video_info(youtube_url, format_selector, deadline, download_from_info)
+
+    # Final path after post-processing, the same value as yt-dlp --print after_move:filepath
+    requested_downloads = result.get('requested_downloads') or []
+    downloaded_audio_file = requested_downloads[-1].get('filepath') if requested_downloads else None
+    if downloaded_audio_file:
+        logger.info("Downloaded audio file: %s", downloaded_audio_file)
+        return downloaded_audio_file
     raise FileNotFoundError(f"Downloaded audio file not found for: {output_path_without_ext}")
 
-def transcribe_audio_local(file_path, language=None):
-    logger.info(f"Starting transcription for file: {file_path} with language: {language or 'auto'}")
-    result = whisper_model.transcribe(file_path, verbose=False, language=language)
-    logger.info(f"Transcription finished for file: {file_path}")
-    return result['text']
+def video_info_cache_key(youtube_url, format_selector):
+    video_id = extract_video_id(youtube_url)
+    return f"ytinfo:{format_selector}:{video_id}" if video_id else None
+
+async def invalidate_video_info(youtube_url, format_selector):
+    # Cached info may carry a media URL that no longer works (expired, locked to another host's IP, revoked),
+    # so a failed download forces the retry (or the next request) to extract again
+    info_cache_key = video_info_cache_key(youtube_url, format_selector)
+    if info_cache_key:
+        await cache_delete(info_cache_key, store=local_video_info_cache)
+
+async def extract_video_info(youtube_url, format_selector):
+    video_id = extract_video_id(youtube_url)
+    info_cache_key = video_info_cache_key(youtube_url, format_selector)
+    if info_cache_key:
+        cached_info = await cache_get(info_cache_key, store=local_video_info_cache)
+        if cached_info is not None:
+            logger.info("Cache hit for video info: %s", video_id)
+            return json.loads(cached_info), True
+
+    # extract_flat keeps a playlist URL from resolving every entry before it is rejected below
+    options = ytdl_options(format=format_selector, extract_flat='in_playlist')
+
+    def run_extract():
+        with yt_dlp.YoutubeDL(options) as ytdl:
+            return ytdl.sanitize_info(ytdl.extract_info(youtube_url, download=False))
+
+    logger.info("Extracting video info with yt-dlp for: %s", youtube_url)
+    try:
+        # A timed out extraction keeps its thread until yt-dlp's own socket timeouts end it, but only in ytdl_executor
+        info = await asyncio.wait_for(run_in_executor(ytdl_executor, run_extract), timeout=DOWNLOAD_PROCESS_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        logger.error("yt-dlp timed out after %s seconds.", DOWNLOAD_PROCESS_TIMEOUT_SECONDS)
+        raise RuntimeError("Download timed out")
+    except yt_dlp.utils.DownloadError as e:
+        logger.error("yt-dlp failed with error: %s", e)
+        raise RuntimeError(f"yt-dlp error: {str(e)}")
+    if info.get('_type', 'video') != 'video':
+        logger.error("URL did not resolve to a single video: %s", youtube_url)
+        raise RuntimeError("URL must point to a single YouTube video, not a playlist or channel")
+    if not info.get('format_id'):
+        logger.error("No downloadable audio format found for: %s", youtube_url)
+        raise RuntimeError("No downloadable audio format found for this video")
+
+    if info_cache_key:
+        # Video formats, storyboards, thumbnails and captions make up nearly all of the info's size and are never
+        # used here, so only the cached copy is trimmed
+        info_to_cache = dict(info)
+        if 'formats' in info:
+            # Same predicate as yt-dlp's own "ba" selection, plus the format it already picked
+            info_to_cache['formats'] = [
+                fmt for fmt in info['formats']
+                if (fmt.get('vcodec') == 'none' and fmt.get('acodec') != 'none') or fmt.get('format_id') == info['format_id']
+            ]
+        for key in ('thumbnails', 'automatic_captions', 'subtitles', 'requested_subtitles', 'heatmap'):
+            info_to_cache.pop(key, None)
+        await cache_set(
+            info_cache_key,
+            json.dumps(info_to_cache),
+            ttl=VIDEO_INFO_CACHE_TTL_SECONDS,
+            store=local_video_info_cache,
+            max_entries=VIDEO_INFO_CACHE_MAX_ENTRIES
+        )
+    return info, False
+
+async def download_with_video_info(youtube_url, format_selector, deadline, download):
+    info, from_cache = await extract_video_info(youtube_url, format_selector)
+    while True:
+        try:
+            return await download(info)
+        except RuntimeError:
+            await invalidate_video_info(youtube_url, format_selector)
+            # A media URL from the cache may have expired or be locked to another host's IP, so fresh info gets
+            # one more attempt within the same request
+            if not from_cache or time.monotonic() >= deadline:
+                raise
+        logger.warning("Download from cached video info failed, extracting again for: %s", youtube_url)
+        info, _ = await extract_video_info(youtube_url, format_selector)
+        from_cache = False
+
+# Cleanup tasks that outlive a cancelled request, referenced here so they are not garbage collected mid-run
+background_tasks = set()
+
+async def decode_audio_pcm(info, deadline):
+    stop_download = threading.Event()
+
+    def on_progress(progress):
+        # Raising from a progress hook is the only way to stop yt-dlp's downloader mid-transfer
+        if stop_download.is_set() or time.monotonic() > deadline:
+            raise yt_dlp.utils.DownloadCancelled("Download timed out")
+
+    options = ytdl_options(format='bestaudio', nopart=True, progress_hooks=[on_progress])
+
+    with tempfile.TemporaryDirectory(dir=TEMP_AUDIO_DIR, ignore_cleanup_errors=True) as temp_dir:
+        # yt-dlp writes into a FIFO that ffmpeg reads from, so no audio file is written
+        fifo_path = os.path.join(temp_dir, "audio.fifo")
+        os.mkfifo(fifo_path)
+        # While we hold a read end, yt-dlp opening the FIFO never blocks, even if ffmpeg has already exited
+        fifo_read_fd = os.open(fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+
+        def run_download():
+            try:
+                with yt_dlp.YoutubeDL(options) as ytdl:
+                    # Same format selection as yt-dlp --load-info-json, then yt-dlp's own downloader
+                    if not ytdl.dl(fifo_path, ytdl.process_ie_result(info, download=False)):
+                        return "Download failed"
+            except yt_dlp.utils.DownloadCancelled:
+                # Stopped because ffmpeg exited, whose own error is reported instead, or because the deadline passed
+                return None if stop_download.is_set() else "Download timed out"
+            except yt_dlp.utils.YoutubeDLError as e:
+                return str(e)
+            finally:
+                # ffmpeg waits in open() until a writer appears; this one gives it EOF if yt-dlp failed first
+                try:
+                    os.close(os.open(fifo_path, os.O_WRONLY | os.O_NONBLOCK))
+                except OSError:
+                    pass
+            return None
+
+        ffmpeg_cmd = [
+            'ffmpeg',
+            '-hide_banner',
+            '-nostats',
+            '-loglevel', 'error',
+            '-i', fifo_path,
+            '-f', 's16le',
+            '-ac', '1',
+            '-ar', str(SAMPLE_RATE),
+            'pipe:1'
+        ]
+        logger.info("Running yt-dlp download into ffmpeg command: %s", ffmpeg_cmd)
+        try:
+            ffmpeg_proc = await asyncio.create_subprocess_exec(
+                *ffmpeg_cmd,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+        except Exception:
+            os.close(fifo_read_fd)
+            raise
+        download = asyncio.create_task(run_in_executor(ytdl_executor, run_download))
+
+        async def release_fifo():
+            # Once ffmpeg is gone, whatever yt-dlp still writes is discarded until its progress hook stops it,
+            # so it never blocks on a full FIFO
+            try:
+                while not download.done():
+                    try:
+                        os.read(fifo_read_fd, 1024 * 1024)
+                    except BlockingIOError:
+                        pass
+                    await asyncio.wait([download], timeout=0.1)
+            finally:
+                os.close(fifo_read_fd)
+
+        # Only the last lines of stderr are kept for the error message, so memory stays constant however much is logged
+        ffmpeg_stderr_tail = deque(maxlen=PROCESS_ERROR_TAIL_LINES)
+
+        async def collect_stderr():
+            while True:
+                try:
+                    line = await ffmpeg_proc.stderr.readline()
+                except ValueError:
+                    # A line over the stream limit is discarded by readline, so skip it instead of failing the request
+                    ffmpeg_stderr_tail.append("[line too long, skipped]")
+                    continue
+                if not line:
+                    break
+                ffmpeg_stderr_tail.append(line.decode(errors="replace").rstrip())
+
+        async def run_pipeline():
+            pcm, _ = await asyncio.gather(ffmpeg_proc.stdout.read(), collect_stderr())
+            await ffmpeg_proc.wait()
+            return pcm
+
+        try:
+            pcm = await asyncio.wait_for(run_pipeline(), timeout=max(deadline - time.monotonic(), 0))
+        except asyncio.TimeoutError:
+            logger.error("yt-dlp timed out after %s seconds.", DOWNLOAD_PROCESS_TIMEOUT_SECONDS)
+            raise RuntimeError("Download timed out")
+        finally:
+            # Also reached on request cancellation, shutdown and unexpected errors, none of which may leave
+            # ffmpeg or the download behind
+            stop_download.set()
+            if ffmpeg_proc.returncode is None:
+                ffmpeg_proc.kill()
+                await ffmpeg_proc.wait()
+            release = asyncio.create_task(release_fifo())
+            background_tasks.add(release)
+            release.add_done_callback(background_tasks.discard)
+        await release
+        download_error = download.result()
 
-def transcribe_audio_openai(file_path, language=None):
-    logger.info(f"Starting OpenAI Whisper API transcription for file: {file_path} with language: {language or 'auto'}")
-    if not OPENAI_API_KEY:
+    if download_error:
+        logger.error("yt-dlp failed with error: %s", download_error)
+        raise RuntimeError(f"yt-dlp error: {download_error}")
+    if ffmpeg_proc.returncode != 0:
+        error_output = "\n".join(ffmpeg_stderr_tail).strip()
+        logger.error("ffmpeg failed with error: %s", error_output)
+        raise RuntimeError(f"ffmpeg error: {error_output}")
+    if not pcm:
+        raise RuntimeError("Downloaded audio stream is empty")
+    logger.info("Audio stream completed successfully (%.1f seconds of audio).", len(pcm) / (2 * SAMPLE_RATE))
+    return pcm
+
+async def stream_audio_pcm(youtube_url):
+    # Extraction (cached) and yt-dlp's own downloader both run in-process, so YouTube's chunked range requests and
+    # per-format cookies are honoured without a yt-dlp CLI per request; ffmpeg decodes the bytes to 16 kHz mono s16le PCM
+    deadline = time.monotonic() + DOWNLOAD_PROCESS_TIMEOUT_SECONDS
+    return await download_with_video_info(youtube_url, 'bestaudio', deadline, lambda info: decode_audio_pcm(info, deadline))
+
+def transcribe_audio_local(pcm, language=None):
+    logger.info("Starting transcription for %.1f seconds of audio with language: %s", len(pcm) / (2 * SAMPLE_RATE), language or 'auto')
+    audio = np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768.0
+    # VAD splits the audio into speech chunks which are decoded WHISPER_BATCH_SIZE at a time
+    segments, info = batched_model.transcribe(
+        audio,
+        language=language,
+        beam_size=5,
+        vad_filter=True,
+        vad_parameters=WHISPER_VAD_PARAMETERS,
+        batch_size=WHISPER_BATCH_SIZE
+    )
+    # segments is a lazy generator, decoding happens while joining
+    text = "".join(segment.text for segment in segments).strip()
+    logger.info("Transcription finished (detected language: %s)", info.language)
+    return text
+
+logger.info("Warming up Whisper model...")
+start_warmup_time = time.time()
+# Silence is dropped by the VAD, so decode one 30 s window directly to prime the allocator and kernel caches,
+# then run the exact request path so the Silero VAD session and batched pipeline are loaded too
+warmup_segments, _ = whisper_model.transcribe(np.zeros(SAMPLE_RATE * 30, dtype=np.float32), language="en", beam_size=5)
+for _ in warmup_segments:
+    pass
+transcribe_audio_local(bytes(2 * SAMPLE_RATE * 30), "en")
+warmup_time = time.time() - start_warmup_time
+logger.info("Whisper model warmed up in %.2f seconds.", warmup_time)
+
+async def transcribe_audio_openai(file_path, language=None):
+    logger.info("Starting OpenAI Whisper API transcription for file: %s with language: %s", file_path, language or 'auto')
+    if openai_client is None:
         logger.error("OpenAI API key not found in environment variables")
         raise RuntimeError("OpenAI API key not configured")
 
-    client = openai.OpenAI(api_key=OPENAI_API_KEY)
     try:
-        with open(file_path, "rb") as audio_file:
-            kwargs = {
-                "model": OPENAI_WHISPER_MODEL,
-                "file": audio_file
-            }
-            if language:
-                kwargs["language"] = language
+        # A Path is read by the SDK without blocking the event loop
+        kwargs = {
+            "model": OPENAI_WHISPER_MODEL,
+            "file": Path(file_path)
+        }
+        if language:
+            kwargs["language"] = language
 
-            transcription = client.audio.transcriptions.create(**kwargs)
+        transcription = await openai_client.audio.transcriptions.create(**kwargs)
 
-        logger.info(f"OpenAI Whisper API transcription finished for file: {file_path}")
+        logger.info("OpenAI Whisper API transcription finished for file: %s", file_path)
         return transcription.text
     except Exception as e:
-        logger.error(f"OpenAI Whisper API transcription failed: {str(e)}")
+        logger.error("OpenAI Whisper API transcription failed: %s", e)
         raise RuntimeError(f"OpenAI Whisper API error: {str(e)}")
 
-@app.route("/api/v1/transcribe", methods=["POST"])
-def transcribe():
+@app.post("/api/v1/transcribe")
+async def transcribe(request: Request):
     logger.info("Received request to /api/v1/transcribe")
-    if not request.is_json:
+    if request.headers.get("content-type", "").split(";")[0].strip() != "application/json":
         logger.warning("Request content-type not application/json")
-        return jsonify({"success": False, "message": "Content-Type must be application/json", "data": None}), 415
+        return JSONResponse({"success": False, "message": "Content-Type must be application/json", "data": None}, status_code=415)
+
+    try:
+        data = await request.json()
+    except ValueError:
+        logger.warning("Request body is not valid JSON")
+        return JSONResponse({"success": False, "message": "Invalid JSON body", "data": None}, status_code=400)
+    if not isinstance(data, dict):
+        logger.warning("Request body is not a JSON object")
+        return JSONResponse({"success": False, "message": "Request body must be a JSON object", "data": None}, status_code=400)
 
-    data = request.get_json()
     youtube_url = data.get("youtube_url")
     language = data.get("language")  # Optional: None for auto-detection, or specific language code
     if not youtube_url:
         logger.warning("Missing youtube_url in request")
-        return jsonify({"success": False, "message": "Missing youtube_url", "data": None}), 400
+        return JSONResponse({"success": False, "message": "Missing youtube_url", "data": None}, status_code=400)
+    if not isinstance(youtube_url, str):
+        logger.warning("youtube_url in request is not a string")
+        return JSONResponse({"success": False, "message": "youtube_url must be a string", "data": None}, status_code=400)
+    if len(youtube_url) > MAX_YOUTUBE_URL_LENGTH:
+        logger.warning("youtube_url in request is too long (%s characters)", len(youtube_url))
+        return JSONResponse({"success": False, "message": f"youtube_url must be at most {MAX_YOUTUBE_URL_LENGTH} characters", "data": None}, status_code=400)
+    if WHISPER_ENGLISH_ONLY:
+        if language not in (None, "en"):
+            logger.warning("Language %s requested from English-only model %s", language, WHISPER_MODEL_SIZE)
+            return JSONResponse({"success": False, "message": f"Model {WHISPER_MODEL_SIZE} only supports English (\"en\")", "data": None}, status_code=400)
+        # Auto-detection would pick other languages the model can't transcribe
+        language = "en"
 
     youtube_url = clean_youtube_url(youtube_url)
-    logger.info(f"Cleaned YouTube URL: {youtube_url}")
+    logger.info("Cleaned YouTube URL: %s", youtube_url)
 
-    unique_filename = str(uuid.uuid4())
-    output_template = os.path.join(TEMP_AUDIO_DIR, unique_filename)
-    downloaded_audio_file = None
+    cache_model = f"local:{WHISPER_MODEL_SIZE}"
+    video_id = extract_video_id(youtube_url)
+    video_cache_key = transcription_cache_key(cache_model, language, "video", video_id) if video_id else None
+    if video_cache_key:
+        cached_text = await cache_get(video_cache_key)
+        if cached_text is not None:
+            logger.info("Cache hit for video: %s", video_id)
+            return JSONResponse({"success": True, "message": "Transcription completed", "data": {"transcription": cached_text}})
 
     try:
-        logger.info(f"Initiating download for URL: {youtube_url}")
-        downloaded_audio_file = download_audio(youtube_url, output_template)
-        logger.info(f"Audio download successful: {downloaded_audio_file}")
-        
-        logger.info("Starting transcription")
-        text = transcribe_audio_local(downloaded_audio_file, language)
-        logger.info("Transcription successful")
-        
-        return jsonify({"success": True, "message": "Transcription completed", "data": {"transcription": text}})
-    except Exception as e:
-        logger.error(f"Error during transcription flow: {str(e)}")
-        return jsonify({"success": False, "message": str(e), "data": None}), 500
-    finally:
-        if downloaded_audio_file and os.path.exists(downloaded_audio_file):
-            try:
-                os.remove(downloaded_audio_file)
-                logger.info(f"Temporary file removed: {downloaded_audio_file}")
-            except Exception as e_remove:
-                logger.error(f"Error removing temporary file {downloaded_audio_file}: {str(e_remove)}")
+        logger.info("Initiating audio stream for URL: %s", youtube_url)
+        pcm = await stream_audio_pcm(youtube_url)
+        logger.info("Audio stream successful")
+
+        audio_hash = await asyncio.to_thread(lambda: hashlib.sha256(pcm).hexdigest())
+        audio_cache_key = transcription_cache_key(cache_model, language, "audio", audio_hash)
+        text = await cache_get(audio_cache_key)
+        if text is not None:
+            logger.info("Cache hit for audio content: %s", audio_hash)
         else:
-            logger.warning(f"Temporary file {downloaded_audio_file} not found for deletion")
+            logger.info("Starting transcription")
+            # Local Whisper is CPU/GPU-bound, keep it off the event loop
+            text = await run_in_executor(whisper_executor, transcribe_audio_local, pcm, language)
+            logger.info("Transcription successful")
+            await cache_set(audio_cache_key, text)
+        if video_cache_key:
+            await cache_set(video_cache_key, text)
 
-@app.route("/api/v2/transcribe", methods=["POST"])
-def transcribe_openai():
+        return JSONResponse({"success": True, "message": "Transcription completed", "data": {"transcription": text}})
+    except Exception as e:
+        logger.error("Error during transcription flow: %s", e)
+        return JSONResponse({"success": False, "message": str(e), "data": None}, status_code=500)
+
+@app.post("/api/v2/transcribe")
+async def transcribe_openai(request: Request):
     logger.info("Received request to /api/v2/transcribe")
-    if not request.is_json:
+    if request.headers.get("content-type", "").split(";")[0].strip() != "application/json":
         logger.warning("Request content-type not application/json")
-        return jsonify({"success": False, "message": "Content-Type must be application/json", "data": None}), 415
+        return JSONResponse({"success": False, "message": "Content-Type must be application/json", "data": None}, status_code=415)
+
+    try:
+        data = await request.json()
+    except ValueError:
+        logger.warning("Request body is not valid JSON")
+        return JSONResponse({"success": False, "message": "Invalid JSON body", "data": None}, status_code=400)
+    if not isinstance(data, dict):
+        logger.warning("Request body is not a JSON object")
+        return JSONResponse({"success": False, "message": "Request body must be a JSON object", "data": None}, status_code=400)
 
-    data = request.get_json()
     youtube_url = data.get("youtube_url")
     language = data.get("language")
     if not youtube_url:
         logger.warning("Missing youtube_url in request")
-        return jsonify({"success": False, "message": "Missing youtube_url", "data": None}), 400
+        return JSONResponse({"success": False, "message": "Missing youtube_url", "data": None}, status_code=400)
+    if not isinstance(youtube_url, str):
+        logger.warning("youtube_url in request is not a string")
+        return JSONResponse({"success": False, "message": "youtube_url must be a string", "data": None}, status_code=400)
+    if len(youtube_url) > MAX_YOUTUBE_URL_LENGTH:
+        logger.warning("youtube_url in request is too long (%s characters)", len(youtube_url))
+        return JSONResponse({"success": False, "message": f"youtube_url must be at most {MAX_YOUTUBE_URL_LENGTH} characters", "data": None}, status_code=400)
 
     youtube_url = clean_youtube_url(youtube_url)
-    logger.info(f"Cleaned YouTube URL: {youtube_url}")
+    logger.info("Cleaned YouTube URL: %s", youtube_url)
 
-    unique_filename = str(uuid.uuid4())
-    output_template = os.path.join(TEMP_AUDIO_DIR, unique_filename)
-    downloaded_audio_file = None
+    cache_model = f"openai:{OPENAI_WHISPER_MODEL}"
+    video_id = extract_video_id(youtube_url)
+    video_cache_key = transcription_cache_key(cache_model, language, "video", video_id) if video_id else None
+    if video_cache_key:
+        cached_text = await cache_get(video_cache_key)
+        if cached_text is not None:
+            logger.info("Cache hit for video: %s", video_id)
+            return JSONResponse({"success": True, "message": "Transcription completed", "data": {"transcription": cached_text}})
 
     try:
-        logger.info(f"Initiating download for URL: {youtube_url}")
-        downloaded_audio_file = download_audio(youtube_url, output_template)
-        logger.info(f"Audio download successful: {downloaded_audio_file}")
-        
-        logger.info("Starting OpenAI Whisper API transcription")
-        text = transcribe_audio_openai(downloaded_audio_file, language)
-        logger.info("OpenAI Whisper API transcription successful")
-        
-        return jsonify({"success": True, "message": "Transcription completed", "data": {"transcription": text}})
+        # The per-request directory and everything yt-dlp writes into it are removed on exit
+        with tempfile.TemporaryDirectory(dir=TEMP_AUDIO_DIR, ignore_cleanup_errors=True) as temp_dir:
+            logger.info("Initiating download for URL: %s", youtube_url)
+            downloaded_audio_file = await download_audio(youtube_url, os.path.join(temp_dir, "audio"))
+            logger.info("Audio download successful: %s", downloaded_audio_file)
+
+            audio_hash = await asyncio.to_thread(hash_audio_file, downloaded_audio_file)
+            audio_cache_key = transcription_cache_key(cache_model, language, "audio", audio_hash)
+            text = await cache_get(audio_cache_key)
+            if text is not None:
+                logger.info("Cache hit for audio content: %s", audio_hash)
+            else:
+                logger.info("Starting OpenAI Whisper API transcription")
+                text = await transcribe_audio_openai(downloaded_audio_file, language)
+                logger.info("OpenAI Whisper API transcription successful")
+                await cache_set(audio_cache_key, text)
+        if video_cache_key:
+            await cache_set(video_cache_key, text)
+
+        return JSONResponse({"success": True, "message": "Transcription completed", "data": {"transcription": text}})
     except Exception as e:
-        logger.error(f"Error during OpenAI Whisper API transcription flow: {str(e)}")
-        return jsonify({"success": False, "message": str(e), "data": None}), 500
-    finally:
-        if downloaded_audio_file and os.path.exists(downloaded_audio_file):
-            try:
-                os.remove(downloaded_audio_file)
-                logger.info(f"Temporary file removed: {downloaded_audio_file}")
-            except Exception as e_remove:
-                logger.error(f"Error removing temporary file {downloaded_audio_file}: {str(e_remove)}")
-        else:
-            logger.warning(f"Temporary file {downloaded_audio_file} not found for deletion")
+        logger.error("Error during OpenAI Whisper API transcription flow: %s", e)
+        return JSONResponse({"success": False, "message": str(e), "data": None}, status_code=500)
 
 if __name__ == "__main__":
-    logger.info("Starting Flask app on 0.0.0.0:8080")
-    app.run(host="0.0.0.0", port=8080, debug=False)
\ No newline at end of file
+    logger.info("Starting FastAPI app on 0.0.0.0:8080")
+    uvicorn.run(app, host="0.0.0.0", port=8080)
\ No newline at end of file